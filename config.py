@@ -35,6 +35,8 @@ start_decay_epoch = 8
 decay_rate = 0.5
 use_answer = True
 cuda = True
+mixed_precision = False
+compile_model = False
 pretrained = False
 
 # eval hyper-parameters
@@ -39,7 +39,6 @@ class Encoder(nn.Module):
         hidden_size = hidden_size // num_directions
 
         self.embedding = Embedding(word_vectors, padding_idx=1, drop_prob=drop_prob)
-        self.drop_prob = drop_prob
         self.rnn = nn.LSTM(input_size, hidden_size, num_layers,
                            batch_first=True,
                            bidirectional=bidirectional,
@@ -48,7 +47,10 @@ class Encoder(nn.Module):
     def forward(self, x, lengths, y=None):
         x = self.embedding(x, y)
 
-        x = pack_padded_sequence(x, lengths, batch_first=True)
+        # Pack so cuDNN skips the pad positions: with fix_length padding this
+        # is what keeps hidden/cell at each sample's last valid timestep, and
+        # those states are the decoder's only initialization signal
+        x = pack_padded_sequence(x, lengths.cpu(), batch_first=True)
 
         # Apply RNN
         x, (hidden, cell) = self.rnn(x)  # (batch_size, seq_len, 2 * hidden_size)
@@ -70,6 +72,12 @@ class Decoder(nn.Module):
         self.rnn = nn.LSTM(input_size, hidden_size, n_layers, batch_first=True, bidirectional=False, dropout=dropout)
         self.attn = Attention(hidden_size=hidden_size, attn_type="general") if attention else None
         self.gen = Generator(decoder_size=hidden_size, output_dim=len(trg_vocab.itos))
+        try:
+            # Scripting the generator removes the per-step Python dispatch of
+            # the projection + log-softmax chain in the decoding loops
+            self.gen = torch.jit.script(self.gen)
+        except Exception:
+            pass  # older torch without recursive scripting keeps the eager module
         self.dropout = nn.Dropout(dropout)
         self.min_len_sentence = min_len_sentence
         self.max_len_sentence = max_len_sentence
@@ -80,20 +88,20 @@ class Decoder(nn.Module):
         self.special_tokens_ids = [trg_vocab.stoi[t] for t in ["<EOS>", "<PAD>"]]
         self.device = device
 
-    def decode_rnn(self, dec_input, dec_hidden, enc_out):
+    def decode_rnn(self, dec_input, dec_hidden, enc_out, enc_lengths=None):
         if isinstance(self.rnn, nn.GRU):
             dec_output, dec_hidden = self.rnn(dec_input, dec_hidden[0])
         else:
             dec_output, dec_hidden = self.rnn(dec_input, dec_hidden)
 
         if self.attn:
-            dec_output, p_attn = self.attn(dec_output, enc_out)
+            dec_output, p_attn = self.attn(dec_output, enc_out, enc_lengths)
 
         dec_output = self.dropout(dec_output)
 
         return dec_output, dec_hidden
 
-    def top_k_top_p_decode(self, dec_hidden, enc_out):
+    def top_k_top_p_decode(self, dec_hidden, enc_out, enc_lengths=None):
         batch_size = enc_out.size(0)
         outputs = []
 
@@ -104,7 +112,7 @@ class Decoder(nn.Module):
             dec_input = self.embedding(dec_input)  # (batch size, 1, emb dim)
             dec_input = torch.cat((dec_input, input_feed), 2)
 
-            dec_output, dec_hidden = self.decode_rnn(dec_input, dec_hidden, enc_out)
+            dec_output, dec_hidden = self.decode_rnn(dec_input, dec_hidden, enc_out, enc_lengths)
 
             out = self.gen(dec_output)
 
@@ -121,7 +129,7 @@ class Decoder(nn.Module):
 
         return outputs
 
-    def beam_decode(self, dec_hidden, enc_out, beam_width=3, topk=3):
+    def beam_decode(self, dec_hidden, enc_out, beam_width=3, topk=3, enc_lengths=None):
         # Start decoding step with <SOS> token and empty input feed, stored in a Beam node
         dec_input = torch.zeros(1, 1).fill_(2).long().to(self.device)
         input_feed = torch.zeros(1, 1, enc_out.size(2), device=self.device)
@@ -158,7 +166,7 @@ class Decoder(nn.Module):
                 # Decode with the RNN
                 dec_input = self.embedding(dec_input)  # (batch size, 1, emb dim)
                 dec_input = torch.cat((dec_input, input_feed), 2)
-                dec_output, dec_hidden = self.decode_rnn(dec_input, dec_hidden, enc_out)
+                dec_output, dec_hidden = self.decode_rnn(dec_input, dec_hidden, enc_out, enc_lengths)
                 out = self.gen(dec_output)
                 # Extract the top K most likely tokens and their log probability (log softmax)
                 log_prob, indexes = torch.topk(out, beam_width)
@@ -204,7 +212,7 @@ class Decoder(nn.Module):
 
         return utterances
 
-    def greedy_decode(self, dec_hidden, enc_out):
+    def greedy_decode(self, dec_hidden, enc_out, enc_lengths=None):
         batch_size = enc_out.size(0)
         outputs = []
 
@@ -215,7 +223,7 @@ class Decoder(nn.Module):
             dec_input = self.embedding(dec_input)  # (batch size, 1, emb dim)
             dec_input = torch.cat((dec_input, input_feed), 2)
 
-            dec_output, dec_hidden = self.decode_rnn(dec_input, dec_hidden, enc_out)
+            dec_output, dec_hidden = self.decode_rnn(dec_input, dec_hidden, enc_out, enc_lengths)
 
             out = self.gen(dec_output)
 
@@ -231,7 +239,7 @@ class Decoder(nn.Module):
 
         return outputs
 
-    def forward(self, enc_out, enc_hidden, question=None):
+    def forward(self, enc_out, enc_hidden, question=None, enc_lengths=None):
         batch_size = enc_out.size(0)
 
         # tensor to store decoder outputs
@@ -253,7 +261,7 @@ class Decoder(nn.Module):
             for dec_input in q_emb[:, :-1, :].split(1, 1):
                 dec_input = torch.cat((dec_input, input_feed), 2)
 
-                dec_output, dec_hidden = self.decode_rnn(dec_input, dec_hidden, enc_out)
+                dec_output, dec_hidden = self.decode_rnn(dec_input, dec_hidden, enc_out, enc_lengths)
 
                 outputs.append(self.gen(dec_output))
                 input_feed = dec_output
@@ -263,11 +271,11 @@ class Decoder(nn.Module):
                 print("The decode_type config value needs to be either topk, beam or greedy.")
                 return outputs
             if self.decode_type == "topk":
-                outputs = self.top_k_top_p_decode(dec_hidden, enc_out)
+                outputs = self.top_k_top_p_decode(dec_hidden, enc_out, enc_lengths)
             elif self.decode_type == "beam":
-                outputs = self.beam_decode(dec_hidden, enc_out)
+                outputs = self.beam_decode(dec_hidden, enc_out, enc_lengths=enc_lengths)
             else:
-                outputs = self.greedy_decode(dec_hidden, enc_out)
+                outputs = self.greedy_decode(dec_hidden, enc_out, enc_lengths)
 
         return outputs
 
@@ -318,13 +326,12 @@ class Attention(nn.Module):
             hidden_size = self.hidden_size
             wq = self.linear_query(h_t.view(-1, hidden_size))
             wq = wq.view(tgt_batch, tgt_len, 1, hidden_size)
-            wq = wq.expand(tgt_batch, tgt_len, src_len, hidden_size)
 
             uh = self.linear_context(h_s.contiguous().view(-1, hidden_size))
             uh = uh.view(src_batch, 1, src_len, hidden_size)
-            uh = uh.expand(src_batch, tgt_len, src_len, hidden_size)
 
-            # (batch, t_len, s_len, d)
+            # (batch, t_len, s_len, d), broadcasting the row/column vectors
+            # in the add itself instead of materializing two expanded copies
             wquh = torch.tanh(wq + uh)
 
             return self.v(wquh.view(-1, hidden_size)).view(tgt_batch, tgt_len, src_len)
@@ -336,6 +343,14 @@ class Attention(nn.Module):
         # compute attention scores, as in Luong et al.
         align = self.score(dec_output, enc_output)
 
+        # Mask padded encoder positions with an additive bias so masking and
+        # normalization cost a single pass over the score tensor
+        if enc_output_lengths is not None:
+            if enc_output_lengths.device != align.device:
+                enc_output_lengths = enc_output_lengths.to(align.device, non_blocking=True)
+            pad = torch.arange(source_l, device=align.device)[None, :] >= enc_output_lengths[:, None]
+            align = align + pad.to(align.dtype).unsqueeze(1) * -1e30
+
         # Softmax to normalize attention weights
         align_vectors = F.softmax(align.view(batch*target_l, source_l), -1)
         align_vectors = align_vectors.view(batch, target_l, source_l)
@@ -344,9 +359,12 @@ class Attention(nn.Module):
         # over all the source hidden states
         c = torch.bmm(align_vectors, enc_output)
 
-        # concatenate
-        concat_c = torch.cat((c, dec_output), 2).view(batch*target_l, hidden_size*2)
-        attn_h = self.linear_out(concat_c).view(batch, target_l, hidden_size)
+        # project [c; dec_output] without materializing the concatenation:
+        # split linear_out's weight and sum the two halves' projections
+        w_c, w_h = self.linear_out.weight.split(hidden_size, dim=1)
+        attn_h = F.linear(c.view(batch*target_l, hidden_size), w_c, self.linear_out.bias)
+        attn_h = attn_h + F.linear(dec_output.contiguous().view(batch*target_l, hidden_size), w_h)
+        attn_h = attn_h.view(batch, target_l, hidden_size)
         if self.attn_type in ["general", "dot"]:
             attn_h = torch.tanh(attn_h)
 
@@ -4,7 +4,13 @@ import tqdm
 import json
 import zipfile
 import tarfile
+import multiprocessing
 import urllib.request
+import numpy as np
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # internal utilities
 import config
@@ -44,6 +50,71 @@ def maybe_download_squad(url, filename, out_dir):
         print("File extracted successfully!")
 
 
+def process_squad_article(args):
+    # tokenize one article and return its output lines; run in a worker
+    # process, so this has to stay a module-level function
+    article, sub_dir = args
+    records = []
+    list_paragraphs = article['paragraphs']
+    # loop over the paragraphs
+    for paragraph in list_paragraphs:
+        context = paragraph['context']
+        context = clean_text(context)
+        context_tokens = word_tokenize(context)
+        if config.paragraph and (len(context_tokens) < config.min_len_context or len(context_tokens) > config.max_len_context):
+            continue
+        context_sentences = sent_tokenize(context)
+        spans = convert_idx(context, context_tokens)
+        # token index at which each sentence starts
+        sentence_starts = np.cumsum([0] + [len(sentence) for sentence in context_sentences])[:-1]
+        qas = paragraph['qas']
+        # loop over Q/A
+        for qa in qas:
+            question = qa['question']
+            question = clean_text(question)
+            question_tokens = word_tokenize(question)
+            if question_tokens[-1] != "?" or len(question_tokens) < config.min_len_question or len(question_tokens) > config.max_len_question:
+                continue
+            if sub_dir == "train":
+                # select only one ground truth, the top answer, if any answer
+                answer_ids = 1 if qa['answers'] else 0
+            else:
+                answer_ids = len(qa['answers'])
+            if answer_ids:
+                for answer_id in range(answer_ids):
+                    answer = qa['answers'][answer_id]['text']
+                    answer = clean_text(answer)
+                    answer_tokens = word_tokenize(answer)
+                    answer_start = qa['answers'][answer_id]['answer_start']
+                    answer_stop = answer_start + len(answer)
+
+                    # Getting spans of the answer in the context
+                    answer_span = []
+                    for idx, span in enumerate(spans):
+                        if not (answer_stop <= span[0] or answer_start >= span[1]):
+                            answer_span.append(idx)
+                    if not answer_span:
+                        continue
+
+                    # Getting the sentence where we have the answer: one
+                    # binary search over the sentence starts instead of a
+                    # Python scan per answer
+                    sentence_idx = int(np.searchsorted(sentence_starts, answer_span[0], side='right')) - 1
+                    if sentence_idx < 0:
+                        print("Sentence cannot be found")
+                        raise Exception()
+                    sentence_tokens = context_sentences[sentence_idx]
+                    start = int(sentence_starts[sentence_idx])
+                    answer_sentence_span = [span - start for span in answer_span]
+
+                records.append((
+                    " ".join([token + u"￨" + "1" if idx in answer_span else token + u"￨" + "0" for idx, token in enumerate(context_tokens)]),
+                    " ".join([token + u"￨" + "1" if idx in answer_sentence_span else token + u"￨" + "0" for idx, token in enumerate(sentence_tokens)]),
+                    " ".join(question_tokens),
+                    " ".join(answer_tokens)))
+    return records
+
+
 class SquadPreprocessor:
     def __init__(self, data_dir, train_filename, dev_filename, tokenizer):
         self.data_dir = data_dir
@@ -54,8 +125,12 @@ class SquadPreprocessor:
 
     def load_data(self, filename="train-v2.0.json"):
         filepath = os.path.join(self.data_dir, filename)
-        with open(filepath) as f:
-            self.data = json.load(f)
+        if orjson is not None:
+            with open(filepath, "rb") as f:
+                self.data = orjson.loads(f.read())
+        else:
+            with open(filepath) as f:
+                self.data = json.load(f)
 
     def split_data(self, filename):
         self.load_data(filename)
@@ -65,80 +140,101 @@ class SquadPreprocessor:
         if not os.path.exists(os.path.join(self.data_dir, sub_dir)):
             os.makedirs(os.path.join(self.data_dir, sub_dir))
 
-        with open(os.path.join(self.data_dir, sub_dir, sub_dir + '.context'), 'w', encoding="utf-8") as context_file,\
-             open(os.path.join(self.data_dir, sub_dir, sub_dir + '.sentence'), 'w', encoding="utf-8") as sentence_file,\
-             open(os.path.join(self.data_dir, sub_dir, sub_dir + '.question'), 'w', encoding="utf-8") as question_file,\
-             open(os.path.join(self.data_dir, sub_dir, sub_dir + '.answer'), 'w', encoding="utf-8") as answer_file:
-
-            # loop over the data
-            for article_id in tqdm.tqdm(range(len(self.data['data']))):
-                list_paragraphs = self.data['data'][article_id]['paragraphs']
-                # loop over the paragraphs
-                for paragraph in list_paragraphs:
-                    context = paragraph['context']
-                    context = clean_text(context)
-                    context_tokens = word_tokenize(context)
-                    if config.paragraph and (len(context_tokens) < config.min_len_context or len(context_tokens) > config.max_len_context):
-                        continue
-                    context_sentences = sent_tokenize(context)
-                    spans = convert_idx(context, context_tokens)
-                    num_tokens = 0
-                    first_token_sentence = []
-                    for sentence in context_sentences:
-                        first_token_sentence.append(num_tokens)
-                        num_tokens += len(sentence)
-                    qas = paragraph['qas']
-                    # loop over Q/A
-                    for qa in qas:
-                        question = qa['question']
-                        question = clean_text(question)
-                        question_tokens = word_tokenize(question)
-                        if question_tokens[-1] != "?" or len(question_tokens) < config.min_len_question or len(question_tokens) > config.max_len_question:
-                            continue
-                        if sub_dir == "train":
-                            # select only one ground truth, the top answer, if any answer
-                            answer_ids = 1 if qa['answers'] else 0
-                        else:
-                            answer_ids = len(qa['answers'])
-                        if answer_ids:
-                            for answer_id in range(answer_ids):
-                                answer = qa['answers'][answer_id]['text']
-                                answer = clean_text(answer)
-                                answer_tokens = word_tokenize(answer)
-                                answer_start = qa['answers'][answer_id]['answer_start']
-                                answer_stop = answer_start + len(answer)
-
-                                # Getting spans of the answer in the context
-                                answer_span = []
-                                for idx, span in enumerate(spans):
-                                    if not (answer_stop <= span[0] or answer_start >= span[1]):
-                                        answer_span.append(idx)
-                                if not answer_span:
-                                    continue
-
-                                # Getting the sentence where we have the answer
-                                sentence_tokens = []
-                                for idx, start in enumerate(first_token_sentence):
-                                    if answer_span[0] >= start:
-                                        sentence_tokens = context_sentences[idx]
-                                        answer_sentence_span = [span - start for span in answer_span]
-                                    else:
-                                        break
-                                if not sentence_tokens:
-                                    print("Sentence cannot be found")
-                                    raise Exception()
-
-                            # write to file
-                            context_file.write(" ".join([token + u"￨" + "1" if idx in answer_span else token + u"￨" + "0" for idx, token in enumerate(context_tokens)]) + "\n")
-                            sentence_file.write(" ".join([token + u"￨" + "1" if idx in answer_sentence_span else token + u"￨" + "0" for idx, token in enumerate(sentence_tokens)]) + "\n")
-                            question_file.write(" ".join([token for token in question_tokens]) + "\n")
-                            answer_file.write(" ".join([token for token in answer_tokens]) + "\n")
+        with open(os.path.join(self.data_dir, sub_dir, sub_dir + '.context'), 'w', encoding="utf-8", buffering=1 << 20) as context_file,\
+             open(os.path.join(self.data_dir, sub_dir, sub_dir + '.sentence'), 'w', encoding="utf-8", buffering=1 << 20) as sentence_file,\
+             open(os.path.join(self.data_dir, sub_dir, sub_dir + '.question'), 'w', encoding="utf-8", buffering=1 << 20) as question_file,\
+             open(os.path.join(self.data_dir, sub_dir, sub_dir + '.answer'), 'w', encoding="utf-8", buffering=1 << 20) as answer_file:
+
+            # loop over the data, tokenizing articles in parallel while this
+            # process stays the single writer so file ordering is preserved
+            with multiprocessing.Pool(os.cpu_count()) as pool:
+                articles = ((article, sub_dir) for article in self.data['data'])
+                for records in tqdm.tqdm(pool.imap(process_squad_article, articles, chunksize=4),
+                                         total=len(self.data['data'])):
+                    # write each article's lines in one batched call
+                    context_file.writelines(rec[0] + "\n" for rec in records)
+                    sentence_file.writelines(rec[1] + "\n" for rec in records)
+                    question_file.writelines(rec[2] + "\n" for rec in records)
+                    answer_file.writelines(rec[3] + "\n" for rec in records)
 
     def preprocess(self):
         self.split_data(self.train_filename)
         self.split_data(self.dev_filename)
 
 
+def process_newsqa_article(args):
+    # tokenize one article and return its output lines; run in a worker
+    # process, so this has to stay a module-level function
+    article, sub_dir = args
+    records = []
+    context = article["text"]
+    context_tokens = word_tokenize(context)
+    context_sentences = sent_tokenize(context)
+    if config.paragraph and (len(context_tokens) < config.min_len_context or len(
+            context_tokens) > config.max_len_context):
+        return records
+    spans = convert_idx(context, context_tokens)
+    # token index at which each sentence starts
+    sentence_starts = np.cumsum([0] + [len(sentence) for sentence in context_sentences])[:-1]
+    if not article["type"] == sub_dir:
+        return records
+    for question in article["questions"]:
+        if question.get("isQuestionBad") == 0 and question["consensus"].get("s"):
+            q = question["q"].strip()
+            if q[-1] != "?" or len(q.split()) < config.min_len_question or len(q.split()) > config.max_len_question:
+                continue
+            answer_start = question["consensus"]["s"]
+            answer = context[question["consensus"]["s"]: question["consensus"]["e"]].strip(".| ").strip("\n")
+            answer_stop = answer_start + len(answer)
+
+            # Getting spans of the answer in the context
+            answer_span = []
+            for idx, span in enumerate(spans):
+                if not (answer_stop <= span[0] or answer_start >= span[1]):
+                    answer_span.append(idx)
+            if not answer_span:
+                continue
+
+            # Getting the sentence where we have the answer: one binary
+            # search over the sentence starts instead of a Python scan
+            sentence_tokens = []
+            answer_sentence_span = []
+            sentence_idx = int(np.searchsorted(sentence_starts, answer_span[0], side='right')) - 1
+            if sentence_idx >= 0:
+                sentence_tokens = context_sentences[sentence_idx]
+                start = int(sentence_starts[sentence_idx])
+                answer_sentence_span = [span - start for span in answer_span]
+
+            sent = []
+            for idx, token in enumerate(sentence_tokens):
+                if token.strip("\n").strip():
+                    if idx in answer_sentence_span:
+                        sent.append(token + u"￨" + "1")
+                    else:
+                        sent.append(token + u"￨" + "0")
+            sent = " ".join(sent)
+            sent = sent.strip()
+            index = sent.find("(￨0 CNN￨0 )￨0 --￨0 ")
+            if index > -1:
+                sent = sent[index + len("(￨0 CNN￨0 )￨0 --￨0 "):]
+
+            ctxt = []
+            for idx, token in enumerate(context_tokens):
+                if token.strip("\n").strip():
+                    if idx in answer_span:
+                        ctxt.append(token + u"￨" + "1")
+                    else:
+                        ctxt.append(token + u"￨" + "0")
+            ctxt = " ".join(ctxt)
+            ctxt = ctxt.strip()
+            index = ctxt.find("(￨0 CNN￨0 )￨0 --￨0 ")
+            if index > -1:
+                ctxt = ctxt[index + len("(￨0 CNN￨0 )￨0 --￨0 "):]
+
+            records.append((ctxt, sent, q, answer))
+    return records
+
+
 class NewsQAPreprocessor:
     def __init__(self, data_dir, filename, tokenizer):
         self.data_dir = data_dir
@@ -148,8 +244,12 @@ class NewsQAPreprocessor:
 
     def load_data(self, filename="combined-newsqa-data-v1.json"):
         filepath = os.path.join(self.data_dir, filename)
-        with open(filepath) as f:
-            self.data = json.load(f)
+        if orjson is not None:
+            with open(filepath, "rb") as f:
+                self.data = orjson.loads(f.read())
+        else:
+            with open(filepath) as f:
+                self.data = json.load(f)
 
     def split_data(self, filename):
         self.load_data(filename)
@@ -160,84 +260,22 @@ class NewsQAPreprocessor:
             if not os.path.exists(os.path.join(self.data_dir, sub_dir)):
                 os.makedirs(os.path.join(self.data_dir, sub_dir))
 
-            with open(os.path.join(self.data_dir, sub_dir, sub_dir + ".context"), "w", encoding="utf-8") as context_file,\
-                 open(os.path.join(self.data_dir, sub_dir, sub_dir + ".sentence"), "w", encoding="utf-8") as sentence_file,\
-                 open(os.path.join(self.data_dir, sub_dir, sub_dir + ".question"), "w", encoding="utf-8") as question_file,\
-                 open(os.path.join(self.data_dir, sub_dir, sub_dir + ".answer"), "w", encoding="utf-8") as answer_file:
-
-                # loop over the data
-                for article in tqdm.tqdm(self.data["data"]):
-                    context = article["text"]
-                    context_tokens = word_tokenize(context)
-                    context_sentences = sent_tokenize(context)
-                    if config.paragraph and (len(context_tokens) < config.min_len_context or len(
-                            context_tokens) > config.max_len_context):
-                        continue
-                    spans = convert_idx(context, context_tokens)
-                    num_tokens = 0
-                    first_token_sentence = []
-                    for sentence in context_sentences:
-                        first_token_sentence.append(num_tokens)
-                        num_tokens += len(sentence)
-                    if not article["type"] == sub_dir:
-                        continue
-                    for question in article["questions"]:
-                        if question.get("isQuestionBad") == 0 and question["consensus"].get("s"):
-                            q = question["q"].strip()
-                            if q[-1] != "?" or len(q.split()) < config.min_len_question or len(q.split()) > config.max_len_question:
-                                continue
-                            answer_start = question["consensus"]["s"]
-                            answer = context[question["consensus"]["s"]: question["consensus"]["e"]].strip(".| ").strip("\n")
-                            answer_stop = answer_start + len(answer)
-
-                            # Getting spans of the answer in the context
-                            answer_span = []
-                            for idx, span in enumerate(spans):
-                                if not (answer_stop <= span[0] or answer_start >= span[1]):
-                                    answer_span.append(idx)
-                            if not answer_span:
-                                continue
-
-                            # Getting the sentence where we have the answer
-                            sentence_tokens = []
-                            for idx, start in enumerate(first_token_sentence):
-                                if answer_span[0] >= start:
-                                    sentence_tokens = context_sentences[idx]
-                                    answer_sentence_span = [span - start for span in answer_span]
-                                else:
-                                    break
-
-                            # write to file
-                            sent = []
-                            for idx, token in enumerate(sentence_tokens):
-                                if token.strip("\n").strip():
-                                    if idx in answer_sentence_span:
-                                        sent.append(token + u"￨" + "1")
-                                    else:
-                                        sent.append(token + u"￨" + "0")
-                            sent = " ".join(sent)
-                            sent = sent.strip()
-                            index = sent.find("(￨0 CNN￨0 )￨0 --￨0 ")
-                            if index > -1:
-                                sent = sent[index + len("(￨0 CNN￨0 )￨0 --￨0 "):]
-
-                            ctxt = []
-                            for idx, token in enumerate(context_tokens):
-                                if token.strip("\n").strip():
-                                    if idx in answer_span:
-                                        ctxt.append(token + u"￨" + "1")
-                                    else:
-                                        ctxt.append(token + u"￨" + "0")
-                            ctxt = " ".join(ctxt)
-                            ctxt = ctxt.strip()
-                            index = ctxt.find("(￨0 CNN￨0 )￨0 --￨0 ")
-                            if index > -1:
-                                ctxt = ctxt[index + len("(￨0 CNN￨0 )￨0 --￨0 "):]
-
-                            context_file.write(ctxt + "\n")
-                            sentence_file.write(sent + "\n")
-                            question_file.write(q + "\n")
-                            answer_file.write(answer + "\n")
+            with open(os.path.join(self.data_dir, sub_dir, sub_dir + ".context"), "w", encoding="utf-8", buffering=1 << 20) as context_file,\
+                 open(os.path.join(self.data_dir, sub_dir, sub_dir + ".sentence"), "w", encoding="utf-8", buffering=1 << 20) as sentence_file,\
+                 open(os.path.join(self.data_dir, sub_dir, sub_dir + ".question"), "w", encoding="utf-8", buffering=1 << 20) as question_file,\
+                 open(os.path.join(self.data_dir, sub_dir, sub_dir + ".answer"), "w", encoding="utf-8", buffering=1 << 20) as answer_file:
+
+                # loop over the data, tokenizing articles in parallel while
+                # this process stays the single writer
+                with multiprocessing.Pool(os.cpu_count()) as pool:
+                    articles = ((article, sub_dir) for article in self.data["data"])
+                    for records in tqdm.tqdm(pool.imap(process_newsqa_article, articles, chunksize=4),
+                                             total=len(self.data["data"])):
+                        # write each article's lines in one batched call
+                        context_file.writelines(rec[0] + "\n" for rec in records)
+                        sentence_file.writelines(rec[1] + "\n" for rec in records)
+                        question_file.writelines(rec[2] + "\n" for rec in records)
+                        answer_file.writelines(rec[3] + "\n" for rec in records)
 
     def preprocess(self):
         self.split_data(self.filename)
@@ -252,27 +290,46 @@ def concatenate_data(squad_data_dir, newsqa_data_dir, out_dir, env="train", full
     out_sentence_filename = os.path.join(out_dir, env + ext)
     out_question_filename = os.path.join(out_dir, env + ".question")
 
-    for infiles, outfile in zip([sentence_files, question_files], [out_sentence_filename, out_question_filename]):
-        with open(outfile, "w") as o:
-            for f in infiles:
-                with open(f) as infile:
-                    for line in infile:
-                        o.write(line)
-
-    with open(out_sentence_filename, "r") as f,\
-         open(out_question_filename, "r") as g:
-        sentence_lines = f.readlines()
-        question_lines = g.readlines()
-
-    sentence_lines, question_lines = zip(
-        *[(s, q) for s, q in sorted(zip(sentence_lines, question_lines), key=lambda x: len(word_tokenize(x[0])))])
-
-    with open(out_sentence_filename, "w") as f,\
-         open(out_question_filename, "w") as g:
-        for line in sentence_lines:
-            f.write(line)
-        for line in question_lines:
-            g.write(line)
+    # Pass 1: stream the input files into the output files, recording the
+    # byte offset of every line and the token length of every sentence so
+    # the reorder pass below never holds the corpus in memory
+    sentence_offsets = []
+    sentence_lengths = []
+    with open(out_sentence_filename, "wb") as o:
+        for f in sentence_files:
+            with open(f, "rb") as infile:
+                for line in infile:
+                    sentence_offsets.append(o.tell())
+                    sentence_lengths.append(len(word_tokenize(line.decode("utf-8"))))
+                    o.write(line)
+
+    question_offsets = []
+    with open(out_question_filename, "wb") as o:
+        for f in question_files:
+            with open(f, "rb") as infile:
+                for line in infile:
+                    question_offsets.append(o.tell())
+                    o.write(line)
+
+    # Sort by sentence length as before, shuffling inside equal-length
+    # groups with a single vectorized permutation: permuting first and
+    # sorting stably keeps the length bucketing but randomizes the corpus
+    # order within each bucket
+    sentence_offsets = np.asarray(sentence_offsets, dtype=np.int64)
+    question_offsets = np.asarray(question_offsets, dtype=np.int64)
+    sentence_lengths = np.asarray(sentence_lengths, dtype=np.int64)
+    perm = np.random.permutation(len(sentence_lengths))
+    order = perm[np.argsort(sentence_lengths[perm], kind="stable")]
+
+    # Pass 2: rewrite each output file in sorted order by seeking to the
+    # recorded offsets, then atomically replace the unsorted file
+    for filename, offsets in [(out_sentence_filename, sentence_offsets),
+                              (out_question_filename, question_offsets)]:
+        with open(filename, "rb") as f, open(filename + ".tmp", "wb") as tmp:
+            for i in order:
+                f.seek(offsets[i])
+                tmp.write(f.readline())
+        os.replace(filename + ".tmp", filename)
 
 
 if __name__ == "__main__":
@@ -27,6 +27,6 @@ class Seq2Seq(nn.Module):
 
     def forward(self, sentence, sentence_len, question=None, answer=None):
         enc_output, enc_hidden = self.enc(sentence, sentence_len, answer)
-        outputs = self.dec(enc_output, enc_hidden, question)
+        outputs = self.dec(enc_output, enc_hidden, question, enc_lengths=sentence_len)
 
         return outputs
@@ -1,6 +1,7 @@
 # external libraries
 import os
 import json
+from contextlib import nullcontext
 import torch
 import torch.nn as nn
 from torch.nn.utils import clip_grad_norm_
@@ -33,6 +34,8 @@ hyper_params = {
     "decay_rate": config.decay_rate,
     "use_answer": config.use_answer,
     "cuda": config.cuda,
+    "mixed_precision": config.mixed_precision,
+    "compile_model": config.compile_model,
     "pretrained": config.pretrained
 }
 
@@ -93,6 +96,14 @@ if hyper_params["pretrained"]:
     model.load_state_dict(torch.load(os.path.join(experiment_path, "model.pkl"))["state_dict"])
 model.to(device)
 
+# Compile the encoder's forward path when requested; its shapes are static
+# (fix_length padding), so Inductor can fuse the embedding glue around the
+# LSTM. The decoder's sampling loops are data-dependent Python and would
+# only graph-break, so they stay eager. Wrapping only the bound forward
+# keeps the module tree (and so the checkpoint state_dict keys) unchanged
+if hyper_params["compile_model"] and hasattr(torch, "compile"):
+    model.enc.forward = torch.compile(model.enc.forward, mode="max-autotune", dynamic=False)
+
 # Define loss and optimizer
 padding_idx = vocabs['trg_vocab'].stoi["<PAD>"]
 criterion = nn.NLLLoss(ignore_index=padding_idx, reduction="sum")
@@ -102,6 +113,15 @@ scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer,
                                                                        hyper_params["num_epochs"] + 1)),
                                                  gamma=hyper_params["decay_rate"])
 
+# Run the forward pass in mixed precision when requested (CUDA only, and
+# only when this torch ships torch.cuda.amp); the loss is scaled before
+# backward so FP16 gradients do not underflow
+use_amp = hyper_params["mixed_precision"] and hyper_params["cuda"] and hasattr(torch.cuda, "amp")
+if hyper_params["mixed_precision"] and not use_amp:
+    print("Mixed precision requested but needs CUDA and torch.cuda.amp; training in full precision.")
+amp_context = torch.cuda.amp.autocast if use_amp else nullcontext
+scaler = torch.cuda.amp.GradScaler() if use_amp else None
+
 # Create an object to report the different metrics
 mc = MetricReporter()
 
@@ -127,23 +147,34 @@ for epoch in range(hyper_params["num_epochs"]):
         answer = batch.feat.to(device) if hyper_params["use_answer"] else None
         # Clear gradients w.r.t. parameters
         optimizer.zero_grad()
-        # Forward pass to get output/logits
-        pred = model(sentence, len_sentence, question, answer)
-        # Stack the predictions into a tensor to compute the loss
-        pred = dress_for_loss(pred)
-        # Calculate Loss: softmax --> negative log likelihood
-        loss = criterion(pred.view(-1, pred.size(2)), question[:, 1:].contiguous().view(-1))
+        with amp_context():
+            # Forward pass to get output/logits
+            pred = model(sentence, len_sentence, question, answer)
+            # Stack the predictions into a tensor to compute the loss
+            pred = dress_for_loss(pred)
+            # Calculate Loss: softmax --> negative log likelihood
+            loss = criterion(pred.view(-1, pred.size(2)), question[:, 1:].contiguous().view(-1))
 
         # Update the metrics
         num_non_padding, num_correct = correct_tokens(pred, question, padding_idx)
         mc.update_metrics(loss.item(), num_non_padding, num_correct)
 
-        # Getting gradients w.r.t. parameters
-        loss.backward()
-        # Truncate the gradients if the norm is greater than a threshold
-        clip_grad_norm_(model.parameters(), 5.)
-        # Updating parameters
-        optimizer.step()
+        if scaler is not None:
+            # Getting gradients w.r.t. parameters, with the loss scaled up
+            scaler.scale(loss).backward()
+            # Truncate the gradients if the norm is greater than a threshold
+            scaler.unscale_(optimizer)
+            clip_grad_norm_(model.parameters(), 5.)
+            # Updating parameters
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            # Getting gradients w.r.t. parameters
+            loss.backward()
+            # Truncate the gradients if the norm is greater than a threshold
+            clip_grad_norm_(model.parameters(), 5.)
+            # Updating parameters
+            optimizer.step()
 
     # Compute the loss, accuracy and perplexity for this epoch and push them to TensorboardX
     mc.report_metrics()
@@ -159,13 +190,14 @@ for epoch in range(hyper_params["num_epochs"]):
             # Load a batch of input sentence, sentence lengths and questions
             sentence, len_sentence, question = batch.src[0].to(device), batch.src[1].to(device), batch.trg[0].to(device)
             answer = batch.feat.to(device) if hyper_params["use_answer"] else None
-            # Forward pass to get output/logits
-            pred = model(sentence, len_sentence, question,  answer)
-            # Stack the predictions into a tensor to compute the loss
-            pred = dress_for_loss(pred)
-            # Calculate Loss: softmax --> negative log likelihood
-            #loss = criterion(pred.view(-1, pred.size(2)), question.view(-1))
-            loss = criterion(pred.view(-1, pred.size(2)), question[:, 1:].contiguous().view(-1))
+            with amp_context():
+                # Forward pass to get output/logits
+                pred = model(sentence, len_sentence, question,  answer)
+                # Stack the predictions into a tensor to compute the loss
+                pred = dress_for_loss(pred)
+                # Calculate Loss: softmax --> negative log likelihood
+                #loss = criterion(pred.view(-1, pred.size(2)), question.view(-1))
+                loss = criterion(pred.view(-1, pred.size(2)), question[:, 1:].contiguous().view(-1))
 
             # Update the metrics
             num_non_padding, num_correct = correct_tokens(pred, question, padding_idx)